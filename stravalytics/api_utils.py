@@ -1,26 +1,259 @@
 import requests
 import urllib3
+import os
+import json
+import time
+import hashlib
+import copy
+from collections import OrderedDict
 
 # Disable certificate verification warning. See https://urllib3.readthedocs.io/en/latest/advanced-usage.html#tls-warnings
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+
+class ResponseCache:
+    """
+    Cache of JSON responses, kept in memory and on disk, both LRU.
+    Entries are keyed by url (with its query parameters) and by identity,
+    so responses of one athlete are never served to another. They store
+    the ETag and Last-Modified headers, so that they can be revalidated
+    with a conditional request.
+    Failing to read or write the disk cache never makes an API call fail,
+    the entry is then only kept in memory.
+    """
+
+    entry_keys = {'data', 'etag', 'last_modified', 'stored_at'}
+
+    def __init__(self, cache_dir='.stravalytics_cache', identity=None,
+                 max_entries=256, max_files=1000, max_age=60):
+        """
+        cache_dir: folder where responses are stored. None to keep them only in memory.
+        identity: stable string identifying the athlete (e.g. client id and refresh token),
+            only stored hashed. If None, the Authorization header of each call is used,
+            which changes with every access token.
+        max_entries: maximum number of responses kept in memory.
+        max_files: maximum number of responses kept on disk.
+        max_age: seconds during which a cached response is used without revalidation.
+        """
+
+        self.cache_dir = cache_dir
+        self.identity = identity
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self.max_age = max_age
+        self.entries = OrderedDict()
+
+
+    def get_key(self, url, params=None, headers=None):
+        """
+        Cache key of a url requested with the given query parameters and headers.
+        The identity is hashed, so tokens are not stored in plain text.
+        """
+
+        if params:
+            url = requests.Request('GET', url, params=params).prepare().url
+
+        identity = self.identity
+        if identity is None:
+            identity = (headers or {}).get('Authorization', '')
+
+        return url + '#' + hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+    def get_path(self, key):
+        """
+        Path of the file storing the response of a cache key.
+        """
+        filename = hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json'
+        return os.path.join(self.cache_dir, filename)
+
+
+    def get(self, key):
+        """
+        Return the cached entry for a cache key (see get_key()), or None.
+        An entry is a dictionary with keys: data, etag, last_modified, stored_at.
+        """
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        if self.cache_dir is None:
+            return None
+
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            # Mark the file as recently used, for the disk LRU
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+
+        if not self.is_valid(entry):
+            return None
+
+        self._remember(key, entry)
+        return entry
+
+
+    def is_valid(self, entry):
+        """
+        Check if an entry read from disk has the expected shape.
+        """
+        return isinstance(entry, dict) \
+            and set(entry) == self.entry_keys \
+            and isinstance(entry['stored_at'], (int, float)) \
+            and all(entry[k] is None or isinstance(entry[k], str) for k in ('etag', 'last_modified'))
+
+
+    def is_fresh(self, entry):
+        """
+        Check if an entry can be used without revalidating it.
+        """
+        return time.time() - entry['stored_at'] < self.max_age
+
+
+    def store(self, key, data, etag=None, last_modified=None):
+        """
+        Store a copy of a response in memory and on disk.
+        """
+
+        entry = {
+            'data': copy.deepcopy(data),
+            'etag': etag,
+            'last_modified': last_modified,
+            'stored_at': time.time(),
+        }
+        self._remember(key, entry)
+
+        if self.cache_dir is not None:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                with open(self.get_path(key), 'w', encoding='utf-8') as f:
+                    json.dump(entry, f)
+                self.prune()
+            except (OSError, TypeError, ValueError) as err:
+                print("Response could not be written to the disk cache:", err)
+
+
+    def prune(self):
+        """
+        Remove the least recently used files of the disk cache,
+        keeping at most max_files of them.
+        """
+
+        paths = [os.path.join(self.cache_dir, filename)
+                 for filename in os.listdir(self.cache_dir)
+                 if filename.endswith('.json')]
+
+        if len(paths) <= self.max_files:
+            return
+
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+    def touch(self, key):
+        """
+        Mark an entry as just revalidated (after a 304 Not Modified).
+        """
+
+        entry = self.get(key)
+        if entry is not None:
+            self.store(key, entry['data'], entry['etag'], entry['last_modified'])
+
+
+    def invalidate(self, key):
+        """
+        Remove the entry of a cache key from memory and disk.
+        """
+
+        self.entries.pop(key, None)
+
+        if self.cache_dir is not None:
+            try:
+                os.remove(self.get_path(key))
+            except FileNotFoundError:
+                pass
+            except OSError as err:
+                print("Response could not be removed from the disk cache:", err)
+
+
+    def _remember(self, key, entry):
+        """
+        Keep an entry in memory, evicting the least recently used ones.
+        """
+
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
 class ApiUtils:
     """
-    Simple API utils class that 
+    Simple API utils class that handles the API calls.
+    Responses can be cached by setting response_cache to a ResponseCache.
     """
 
-    def api_call(self, method, url, **kwargs):
+    response_cache = None
+
+    def api_call(self, method, url, use_cache=False, **kwargs):
         """
         Handle API calls.
         examples of method are: "GET", "PUT"
         Returns the JSON response.
+        use_cache: for "GET" calls, use and update self.response_cache,
+            revalidating cached responses with ETag/Last-Modified.
+            Cached responses are returned as copies.
+        Any other method invalidates the cached response of the url (without params).
         """
 
+        cache = self.response_cache
+        cacheable = cache is not None and use_cache and method == 'GET'
+        entry = None
+
+        if cache is not None and method != 'GET':
+            # The params of a PUT are the update, the cached response is the bare url
+            cache.invalidate(cache.get_key(url, headers=kwargs.get('headers')))
+
+        if cacheable:
+            key = cache.get_key(url, kwargs.get('params'), kwargs.get('headers'))
+            entry = cache.get(key)
+            if entry is not None:
+                if cache.is_fresh(entry):
+                    return copy.deepcopy(entry['data'])
+
+                # Ask the server to only send the response if it changed
+                headers = dict(kwargs.get('headers') or {})
+                if entry['etag'] is not None:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified'] is not None:
+                    headers['If-Modified-Since'] = entry['last_modified']
+                kwargs['headers'] = headers
+
         try:
             response = requests.request(method, url, **kwargs)
             # requests.get(url, **kwargs)
+            if response.status_code == 304 and entry is not None:
+                cache.touch(key)
+                return copy.deepcopy(entry['data'])
             response.raise_for_status()
-            return response.json()
+            data = response.json()
+            if cacheable:
+                cache.store(key,
+                            data,
+                            etag=response.headers.get('ETag'),
+                            last_modified=response.headers.get('Last-Modified'))
+            return data
         except requests.exceptions.HTTPError as errh:
             print("HTTP error occurred:", errh)
         except requests.exceptions.ConnectionError as errc:
@@ -29,4 +262,4 @@ class ApiUtils:
             print("Timeout error occurred:", errt)
         except requests.exceptions.RequestException as err:
             print("An unexpected error occurred:", err)
-        return None
\ No newline at end of file
+        return None
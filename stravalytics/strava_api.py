@@ -3,7 +3,7 @@ import os
 import requests
 import pandas as pd
 from stravalytics import weather_api
-from stravalytics.api_utils import ApiUtils 
+from stravalytics.api_utils import ApiUtils, ResponseCache
 
 
 class StravaApiClient(ApiUtils):
@@ -17,10 +17,13 @@ class StravaApiClient(ApiUtils):
     activity_url   = strava_api + '/activities'
 
 
-    def __init__(self):
+    def __init__(self, cache_dir='.stravalytics_cache', use_cache=True):
         """
         Get API credentials from .env.
         Prepare variables to store data
+        cache_dir: folder where activity responses are cached.
+            None to keep them only in memory.
+        use_cache: False to disable the cache of activity responses.
         """
         
         # Data
@@ -35,6 +38,13 @@ class StravaApiClient(ApiUtils):
         client_id     = os.getenv('STRAVA_CLIENT_ID')
         client_secret = os.getenv('STRAVA_CLIENT_SECRET')
 
+        # Cache of activity detail responses, revalidated with ETag/Last-Modified.
+        # Keyed by the athlete credentials, which unlike the access token last across sessions
+        self.response_cache = None
+        if use_cache:
+            self.response_cache = ResponseCache(cache_dir=cache_dir,
+                                                identity=f'{client_id}:{refresh_token}')
+
         # Get an access token. Authorize with payload
         payload = {
             'client_id': f'{client_id}',
@@ -146,11 +156,12 @@ class StravaApiClient(ApiUtils):
     def get_activity(self, activity_id):
         """
         Pull data for one activity using the APU.
+        Responses are cached, and invalidated when the activity is updated.
         Returns a JSON.
         """
         
         url = self.activity_url + '/' + str(activity_id)
-        activity_data = self.api_call('GET', url, headers=self.header)
+        activity_data = self.api_call('GET', url, use_cache=True, headers=self.header)
         return activity_data
     
     
@@ -267,6 +278,29 @@ class StravaApiClient(ApiUtils):
              "\t", count_activities_weather_error, " weather could not be retrieved.")
 
     
+    def add_weather_columns(self, fetch_missing=True, retry_failed=False, weather_history=None):
+        """
+        Add hourly weather columns (temperature, humidity, wind, condition)
+        to self.df_activities, for weather-vs-performance analytics.
+        Weather records are kept in a local table (see weather_api.WeatherHistory),
+        only the days missing from it are requested to the weather API.
+        Days that could not be retrieved before (e.g. older than the weather API
+        plan allows) are only requested again with retry_failed=True.
+        Activities data needs to already be present in self.df_activities.
+        """
+
+        if weather_history is None:
+            weather_history = weather_api.WeatherHistory()
+
+        if fetch_missing:
+            missing_days = weather_history.get_missing_days(self.df_activities,
+                                                            retry_failed=retry_failed)
+            if len(missing_days) > 0:
+                weather_history.fetch_days(missing_days)
+
+        self.df_activities = weather_history.merge_activities(self.df_activities)
+
+    
     def add_weather_to_recent_activities(self, n_days_ago=7, dry_run=True):
         """
         Add weather information to recent the activities from the last days.
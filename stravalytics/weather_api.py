@@ -1,6 +1,8 @@
 from dotenv import load_dotenv
 import os
 import json
+import numpy as np
+import pandas as pd
 from stravalytics.api_utils import ApiUtils 
 
 
@@ -10,9 +12,10 @@ class WeatherApiClient(ApiUtils):
     Can produce a summary of the weather conditions and add an emoji.    
     """
 
-    def __init__(self, lat, lon, date, hour):
+    def __init__(self, lat, lon, date, hour=None):
         """
         Set coordinates, date and time.
+        Without an hour, the weather of the whole day is requested.
         Get WeatherApi key from .env.
         """
         
@@ -41,8 +44,10 @@ class WeatherApiClient(ApiUtils):
             f'http://api.weatherapi.com/v1/history.json?'
             f'key={self.api_key}'
             f'&q={self.lat},{self.lon}'
-            f'&dt={self.date}&hour={self.hour}'
+            f'&dt={self.date}'
         )
+        if self.hour is not None:
+            url += f'&hour={self.hour}'
         return url
         
     
@@ -60,6 +65,26 @@ class WeatherApiClient(ApiUtils):
 
         self.weather_data = weather_data
 
+
+    def get_hourly_weather_data(self):
+        """
+        Call the weather api to get the weather of every hour of the day.
+        Returns a list of hourly weather records in JSON, or None.
+        """
+
+        url = self.get_weatherapi_url()
+
+        weather_data = self.api_call('GET', url)
+
+        if weather_data is None:
+            return None
+
+        try:
+            return weather_data['forecast']['forecastday'][0]['hour']
+        except (KeyError, IndexError, TypeError) as err:
+            print("Unexpected weather data, missing:", err)
+            return None
+
     
     @staticmethod
     def degrees_to_cardinal(d):
@@ -102,6 +127,284 @@ class WeatherApiClient(ApiUtils):
             # return summary, emoji
 
 
+class WeatherHistory:
+    """
+    Local table of hourly weather records (temperature, humidity, wind, condition).
+    Records are grouped in location cells, a grid of cell_size degrees,
+    so that activities close to each other share the same records.
+    The cell_size is stored with the records, since cell numbers
+    are only meaningful for a given cell_size.
+    Days whose weather could not be retrieved are kept in a second table,
+    so that they are not requested again unless asked for.
+    The weather of the activities is added with a single as-of merge.
+    """
+
+    columns = {
+        'cell_size': 'float64',
+        'cell_lat': 'int64',
+        'cell_lon': 'int64',
+        'time': 'datetime64[ns]',
+        'temp_c': 'float64',
+        'humidity': 'Int64',
+        'wind_kph': 'float64',
+        'wind_dir': 'string',
+        'condition': 'string',
+        'is_day': 'boolean',
+    }
+
+    failed_columns = {
+        'cell_size': 'float64',
+        'cell_lat': 'int64',
+        'cell_lon': 'int64',
+        'date': 'datetime64[ns]',
+    }
+
+    # Weather columns added to the activities, with a prefix
+    weather_columns = ['temp_c', 'humidity', 'wind_kph', 'wind_dir', 'condition', 'is_day']
+    prefix = 'weather_'
+
+
+    def __init__(self, filename='weather_history.csv', cell_size=0.1,
+                 failed_filename='weather_history_failed.csv'):
+        """
+        Load the weather records stored in filename, if any,
+        and the days that could not be retrieved, stored in failed_filename.
+        cell_size in degrees, 0.1 is about 11 km. It must match the
+        cell_size of the stored records.
+        """
+
+        self.filename = filename
+        self.failed_filename = failed_filename
+        self.cell_size = cell_size
+        self.df_weather = self.read_csv(self.filename, self.columns, 'time')
+        self.df_failed = self.read_csv(self.failed_filename, self.failed_columns, 'date')
+
+
+    def read_csv(self, filename, columns, time_column):
+        """
+        Read a table from filename, with the given columns and dtypes.
+        Returns an empty table if the file does not exist.
+        Raises ValueError if the table uses a different cell_size.
+        """
+
+        if filename is not None and os.path.exists(filename):
+            df = pd.read_csv(filename, parse_dates=[time_column])
+        else:
+            df = pd.DataFrame(columns=list(columns))
+
+        if 'cell_size' not in df.columns:
+            raise ValueError(f"{filename} does not record the cell_size of its records.")
+
+        cell_sizes = df['cell_size'].unique()
+        if len(cell_sizes) > 0 and not np.allclose(cell_sizes, self.cell_size):
+            raise ValueError(f"{filename} uses cell_size={[float(c) for c in cell_sizes]}, "
+                             f"not cell_size={self.cell_size}.")
+
+        return df.astype(columns)
+
+
+    def write_csv(self):
+        """
+        Store the weather records in self.filename,
+        and the days that could not be retrieved in self.failed_filename.
+        """
+
+        if self.filename is not None:
+            self.df_weather.to_csv(self.filename, index=False)
+        if self.failed_filename is not None:
+            self.df_failed.to_csv(self.failed_filename, index=False)
+
+
+    def add_records(self, new_records):
+        """
+        Add a list of DataFrames of weather records to self.df_weather.
+        Records of an already stored cell and hour replace the old ones.
+        """
+
+        if not new_records:
+            return
+
+        df_weather = pd.concat([self.df_weather] + new_records, ignore_index=True)
+        df_weather = df_weather.drop_duplicates(['cell_lat', 'cell_lon', 'time'], keep='last')
+        self.df_weather = df_weather.astype(self.columns).reset_index(drop=True)
+
+
+    def add_failed(self, failed_days):
+        """
+        Add a list of (cell_lat, cell_lon, date) that could not be retrieved
+        to self.df_failed, and forget the failed days that now have records.
+        """
+
+        keys = ['cell_lat', 'cell_lon', 'date']
+
+        new_failed = pd.DataFrame(failed_days, columns=keys)
+        new_failed['cell_size'] = self.cell_size
+        df_failed = pd.concat([self.df_failed, new_failed[list(self.failed_columns)]],
+                              ignore_index=True)
+        df_failed = df_failed.astype(self.failed_columns).drop_duplicates(keys)
+
+        df_failed = df_failed.merge(self.get_stored_days(), on=keys, how='left', indicator=True)
+        df_failed = df_failed[df_failed['_merge'] == 'left_only']
+
+        self.df_failed = df_failed[list(self.failed_columns)].reset_index(drop=True)
+
+
+    def get_stored_days(self):
+        """
+        Location cells and days with weather records.
+        Returns a DataFrame with columns 'cell_lat', 'cell_lon' and 'date'.
+        """
+
+        stored_days = self.df_weather[['cell_lat', 'cell_lon']].copy()
+        stored_days['date'] = self.df_weather['time'].dt.normalize()
+        return stored_days.drop_duplicates()
+
+
+    def get_activity_keys(self, df_activities):
+        """
+        Location cell and local mid time of the activities with coordinates.
+        Returns a DataFrame with columns 'cell_lat', 'cell_lon' and 'time',
+        indexed as df_activities.
+        """
+
+        has_coords = df_activities['end_lat'].notna() & df_activities['end_lon'].notna()
+        df = df_activities[has_coords]
+
+        # start_date_local is local time labelled as UTC, drop the time zone
+        time = df['mid_time']
+        if time.dt.tz is not None:
+            time = time.dt.tz_localize(None)
+
+        return pd.DataFrame({
+            'cell_lat': np.floor(df['end_lat'] / self.cell_size).astype('int64'),
+            'cell_lon': np.floor(df['end_lon'] / self.cell_size).astype('int64'),
+            'time': time.astype('datetime64[ns]'),
+        }, index=df.index)
+
+
+    def get_missing_days(self, df_activities, retry_failed=False):
+        """
+        Location cells and days of the activities that have no weather records.
+        The day is the one of the hour closest to the activity mid time.
+        Days that could not be retrieved before are skipped, unless retry_failed.
+        Returns a DataFrame with columns 'cell_lat', 'cell_lon' and 'date'.
+        """
+
+        keys = ['cell_lat', 'cell_lon', 'date']
+
+        activity_days = self.get_activity_keys(df_activities)
+        activity_days['date'] = activity_days['time'].dt.round('h').dt.normalize()
+        activity_days = activity_days[keys].drop_duplicates()
+
+        known_days = [self.get_stored_days()]
+        if not retry_failed:
+            known_days.append(self.df_failed[keys])
+        known_days = pd.concat(known_days, ignore_index=True).drop_duplicates()
+
+        missing_days = activity_days.merge(known_days, on=keys, how='left', indicator=True)
+        missing_days = missing_days[missing_days['_merge'] == 'left_only']
+
+        return missing_days[keys].reset_index(drop=True)
+
+
+    def fetch_days(self, missing_days, save_every=50):
+        """
+        Get the hourly weather for each location cell and day in missing_days
+        (see get_missing_days()), one API call per cell and day.
+        The records are added to self.df_weather and written to self.filename
+        every save_every days, and when stopping (even if interrupted).
+        Days that could not be retrieved are added to self.df_failed.
+        """
+
+        new_records = []
+        failed_days = []
+        count_days_error = 0
+
+        try:
+            for cell_lat, cell_lon, date in missing_days.itertuples(index=False):
+                records = self.fetch_day(cell_lat, cell_lon, date)
+                if records is None:
+                    count_days_error += 1
+                    failed_days.append((cell_lat, cell_lon, date))
+                else:
+                    new_records.append(records)
+
+                if len(new_records) + len(failed_days) >= save_every:
+                    self.add_records(new_records)
+                    self.add_failed(failed_days)
+                    self.write_csv()
+                    new_records = []
+                    failed_days = []
+        finally:
+            self.add_records(new_records)
+            self.add_failed(failed_days)
+            self.write_csv()
+
+        print("Weather retrieved for ",
+              len(missing_days) - count_days_error, "/", len(missing_days),
+              "days.")
+
+
+    def fetch_day(self, cell_lat, cell_lon, date):
+        """
+        Get the hourly weather of one location cell and day.
+        Returns a DataFrame of weather records, or None if the weather
+        could not be retrieved.
+        """
+
+        # Request the weather at the center of the cell
+        lat = round((cell_lat + 0.5) * self.cell_size, 4)
+        lon = round((cell_lon + 0.5) * self.cell_size, 4)
+        date = date.strftime('%Y-%m-%d')
+
+        print(f"Getting hourly weather for {lat},{lon} on {date}")
+        weather = WeatherApiClient(lat, lon, date)
+        hours = weather.get_hourly_weather_data()
+
+        if hours is None:
+            return None
+
+        records = pd.json_normalize(hours)
+        records = records.rename(columns={'condition.text': 'condition'})
+        records['time'] = pd.to_datetime(records['time'])
+        records['cell_size'] = self.cell_size
+        records['cell_lat'] = cell_lat
+        records['cell_lon'] = cell_lon
+        return records[list(self.columns)].astype(self.columns)
+
+
+    def merge_activities(self, df_activities, tolerance=pd.Timedelta(minutes=90)):
+        """
+        Add the weather columns to df_activities, using the record of the same
+        location cell closest in time to the activity mid time (within tolerance).
+        Activities without coordinates or records get missing values.
+        Returns a new DataFrame.
+        """
+
+        weather_cols = [self.prefix + col for col in self.weather_columns]
+        df_activities = df_activities.drop(columns=weather_cols, errors='ignore')
+
+        activity_keys = self.get_activity_keys(df_activities)
+        activity_keys['row'] = activity_keys.index
+
+        df_weather = self.df_weather.rename(
+            columns={col: self.prefix + col for col in self.weather_columns}
+        )
+
+        # merge_asof needs both tables sorted by time
+        df_merged = pd.merge_asof(activity_keys.sort_values('time'),
+                                  df_weather.sort_values('time'),
+                                  on='time',
+                                  by=['cell_lat', 'cell_lon'],
+                                  direction='nearest',
+                                  tolerance=tolerance)
+
+        df_merged = df_merged.set_index('row')[weather_cols]
+        df_merged.index.name = df_activities.index.name
+
+        return df_activities.join(df_merged)
+
+
 class WeatherEmojis():
     """
     Utilities to build a mapping between weather emojis (and their